@@ -4,6 +4,11 @@ import logging
 import requests as reqs
 from bs4 import BeautifulSoup
 
+# Outcomes of OverleafClient.check_session
+SESSION_VALID = "valid"
+SESSION_EXPIRED = "expired"
+SESSION_UNREACHABLE = "unreachable"
+
 
 class OverleafClient(object):
 
@@ -23,6 +28,26 @@ class OverleafClient(object):
         self._login_cookies = cookie
         self._csrf = csrf
 
+    def check_session(self):
+        """
+        Check that the login cookie is still accepted, without downloading the dashboard
+        Returns: SESSION_VALID, SESSION_EXPIRED, or SESSION_UNREACHABLE if Overleaf could not tell
+        """
+        try:
+            # An expired session is redirected to the login page, so there is no need to follow redirects
+            # or to read the body of the dashboard
+            r = reqs.get(self._dashboard_url, cookies=self._login_cookies, allow_redirects=False, stream=True)
+            r.close()
+        except reqs.RequestException:
+            logging.exception("Could not reach {}".format(self._dashboard_url))
+            return SESSION_UNREACHABLE
+        if r.status_code == 200:
+            return SESSION_VALID
+        if r.is_redirect or r.status_code in (401, 403):
+            return SESSION_EXPIRED
+        logging.error("Status code {0} when loading {1}".format(r.status_code, self._dashboard_url))
+        return SESSION_UNREACHABLE
+
     def all_projects(self, include_archived=False):
         """
         Get all of a user's projects with status in a given status list
@@ -3,15 +3,26 @@ import click
 import pickle
 import re
 import csv
-
-from clients.OverleafClient import OverleafClient
-from storage.GitStorage import create_or_update_local_backup, push_to_remote
+import sys
+
+from clients.OverleafClient import OverleafClient, SESSION_EXPIRED, SESSION_UNREACHABLE
+from storage.BackupLayout import LAYOUT_FLAT, LAYOUT_SHARDED, LAYOUTS, default_backup_path, name_link_path, \
+    name_link_points_to, is_reserved_name
+from storage.BackupPlan import ACTION_MOVE, ACTION_RENAME, ACTION_LINK, ACTION_PUSH, FAILURE_GIT_AUTH, new_plan, \
+    add_project_to_plan, predict_backup_action, save_plan, log_plan, execute_plan
+from storage.GitExport import export_projects
+from storage.GitMaintenance import MaintenanceScheduler, GIT_STATS_KEY
+from utils.circuit_breaker import CircuitBreaker
 from utils.debug import enable_http_client_debug, is_debug
 
 import os
 import logging
 
 MAX_FILENAME_LENGTH = 40
+# Exit status codes, for schedulers running the backup
+EXIT_SESSION_EXPIRED = 3  # the Overleaf cookie is no longer valid, need to log in again
+EXIT_OVERLEAF_UNAVAILABLE = 4  # Overleaf could not be reached, or too many consecutive failed pulls
+EXIT_GIT_AUTH_FAILED = 5  # git credentials for git.overleaf.com were rejected, need to authenticate git again
 
 
 # From https://github.com/django/django/blob/main/django/utils/text.py
@@ -40,8 +51,10 @@ def sanitize_name(proj, projects_info_list, projects_old_id_to_info):
     # Check if there is another project with the same sanitized name, rename if so
     # Look at projects that have just been considered for backup
     # or look at projects that were backed up during a previous backup session and have a different ID
-    if [p for p in projects_info_list
-        if "backup_up_to_date" in p and p["sanitized_name"] == candidate_name]\
+    # Names reserved for the folders of the sharded layout are treated as clashes too
+    if is_reserved_name(candidate_name) \
+            or [p for p in projects_info_list
+                if "backup_up_to_date" in p and p["sanitized_name"] == candidate_name]\
             or [p for p in projects_old_id_to_info.values()
                 if p["id"] != proj["id"] and p["sanitized_name"] == candidate_name]:
         if len(candidate_name) > MAX_FILENAME_LENGTH - 4:
@@ -56,6 +69,170 @@ def sanitize_name(proj, projects_info_list, projects_old_id_to_info):
     return candidate_name
 
 
+def plan_project_actions(i, proj, projects_info_list, projects_old_id_to_info, projects_csv_id_to_info,
+                         set_of_enable_remote_keys, enable_remote_key, pushed_to_remote_key, backup_git_dir,
+                         remote_type, csv_only, force_push, move_backup, layout=LAYOUT_FLAT):
+    """
+    Decide what needs to be done for a project, without touching the disk or the network.
+    Fills in the project info and returns the list of actions to run, in order.
+    """
+    actions = []
+    proj["url_git"] = "https://git.overleaf.com/%s" % proj["id"]
+    proj_git_url = proj["url_git"]
+
+    # Use project name transformed into valid file/folder name as folder name,
+    # making sure there is no clash with existing shortened names
+    sanitized_proj_name = sanitize_name(proj, projects_info_list, projects_old_id_to_info)
+    proj_backup_path = default_backup_path(backup_git_dir, proj["id"], sanitized_proj_name, layout)
+    proj["sanitized_name"] = sanitized_proj_name
+    proj["layout"] = layout
+    proj["backup_path"] = proj_backup_path  # this is the default, may be overwritten later
+    # True if a move or rename planned below will put the existing backup at proj_backup_path
+    path_will_hold_repo = False
+
+    # Let's see if the user specified a backup path; if so, we stick with it
+    user_specified_backup_path = False
+    user_enable_backup = 1
+    proj["user_backup_path"] = ''
+    if proj["id"] in projects_csv_id_to_info:
+        user_enable_backup = int(projects_csv_id_to_info[proj["id"]]["enable_backup"])
+        csv_proj_backup_path = projects_csv_id_to_info[proj["id"]]["user_backup_path"]
+        old_proj_backup_path = projects_old_id_to_info[proj["id"]]["backup_path"]
+        csv_proj_backup_path = csv_proj_backup_path.strip()
+        if csv_proj_backup_path:
+            # User specified path other than default
+            user_specified_backup_path = True
+            proj_backup_path = csv_proj_backup_path
+            proj["user_backup_path"] = proj_backup_path
+            logging.info("{0}/{1} User specified path {2} for project {3} other than default..."
+                         .format(i + 1, len(projects_info_list), csv_proj_backup_path, sanitized_proj_name))
+            if not csv_only and csv_proj_backup_path != old_proj_backup_path:
+                # user specified path is different from previous backup path
+                if move_backup and not os.path.isdir(csv_proj_backup_path) \
+                        and os.path.isdir(old_proj_backup_path):
+                    # if user specified folder does not exist, we try moving the old backup.
+                    actions.append({'type': ACTION_MOVE, 'src': old_proj_backup_path, 'dst': csv_proj_backup_path})
+                    path_will_hold_repo = True
+                else:
+                    # user specified path exists, unsafe to overwrite with old backup, force git clone or pull
+                    projects_old_id_to_info[proj["id"]]["backup_up_to_date"] = False
+                    logging.info("{0}/{1} Specified existing path different from previous path, "
+                                 "forcing backup...".format(i + 1, len(projects_info_list)))
+                    if os.path.isdir(old_proj_backup_path):
+                        logging.info("{0}/{1} Please consider deleting {2}..."
+                                     .format(i + 1, len(projects_info_list), old_proj_backup_path))
+            else:
+                # Either we are in csv-only mode, or the user-specified path was already used before.
+                # Either way, the current backup path should stay the same as in the json file.
+                proj["backup_path"] = old_proj_backup_path
+        elif "user_backup_path" in projects_old_id_to_info[proj["id"]] \
+                and projects_old_id_to_info[proj["id"]]["user_backup_path"] != csv_proj_backup_path:
+            # User stopped specifying a backup path
+            projects_old_id_to_info[proj["id"]]["backup_up_to_date"] = False
+            logging.info("{0}/{1} User no longer specifying non-default path, going back to default, "
+                         "forcing backup...".format(i + 1, len(projects_info_list)))
+            if os.path.isdir(old_proj_backup_path):
+                logging.info("{0}/{1} Please consider deleting {2}..."
+                             .format(i + 1, len(projects_info_list), old_proj_backup_path))
+
+    proj["enable_backup"] = user_enable_backup
+    proj["backup_up_to_date"] = False
+    # read info about whether remotes are enabled or not, defaulting to no backup
+    for remote_key in set_of_enable_remote_keys:
+        if proj["id"] in projects_csv_id_to_info and remote_key in projects_csv_id_to_info[proj["id"]]:
+            proj[remote_key] = int(projects_csv_id_to_info[proj["id"]][remote_key])
+        else:  # this only applies to projects that were added while another remote was considered
+            proj[remote_key] = 0
+    proj[pushed_to_remote_key] = False
+    # repository statistics stay valid until the backup is updated (they are dropped when it is), so carry them over
+    if proj["id"] in projects_old_id_to_info and GIT_STATS_KEY in projects_old_id_to_info[proj["id"]]:
+        proj[GIT_STATS_KEY] = projects_old_id_to_info[proj["id"]][GIT_STATS_KEY]
+
+    if not user_enable_backup:
+        if proj[enable_remote_key]:
+            logging.info("{0}/{1} User asked to skip local backup but to push to remote for project {2}."
+                         "These settings are incompatible, as local backup is needed for remote push."
+                         .format(i + 1, len(projects_info_list), sanitized_proj_name))
+        # User does not want local backup for this project, skip everything else
+        return actions
+
+    # Handle a potential project name change in Overleaf, or a change of layout of the backup folders
+    old_sanitized_proj_name = None
+    if proj["id"] in projects_old_id_to_info:
+        if projects_old_id_to_info[proj["id"]]["sanitized_name"] != sanitized_proj_name:
+            # specifying old_sanitized_proj_name will force an update in the remote
+            old_sanitized_proj_name = projects_old_id_to_info[proj["id"]]["sanitized_name"]
+        old_proj_backup_path = projects_old_id_to_info[proj["id"]]["backup_path"]
+        # a folder previously specified by the user is not ours to move to the new layout
+        layout_changed = projects_old_id_to_info[proj["id"]].get("layout", LAYOUT_FLAT) != layout \
+            and not projects_old_id_to_info[proj["id"]].get("user_backup_path")
+        # only change local folder name if not specified by user, and if the default folder name changed
+        # (in the sharded layout, folders are named after the project id, so a name change does not move them)
+        if not user_specified_backup_path and (old_sanitized_proj_name or layout_changed) \
+                and old_proj_backup_path != proj_backup_path:
+            if os.path.isdir(old_proj_backup_path):
+                # Renaming is planned even in csv-only mode, as the new default path is recorded in the json file
+                # A folder named like a folder of the sharded layout (backed up before these names were reserved)
+                # must be renamed before any other action creates files inside it
+                actions.append({'type': ACTION_RENAME, 'src': old_proj_backup_path, 'dst': proj_backup_path,
+                                'old_name': old_sanitized_proj_name,
+                                'frees_reserved_name': bool(old_sanitized_proj_name)
+                                and is_reserved_name(old_sanitized_proj_name)})
+                path_will_hold_repo = True
+            else:
+                # There should really be a folder, so if there is none, let's assume we need to backup
+                projects_old_id_to_info[proj["id"]]["backup_up_to_date"] = False
+                logging.info("{0}/{1} Couldn't find previous local backup folder {2} for project {3}, "
+                             "redownloading to folder {4}..."
+                             .format(i + 1, len(projects_info_list), old_proj_backup_path, sanitized_proj_name,
+                                     proj_backup_path))
+
+    # In the sharded layout, keep a link named after the project pointing to its folder
+    if layout == LAYOUT_SHARDED and not user_specified_backup_path:
+        link_path = name_link_path(backup_git_dir, sanitized_proj_name)
+        old_link_path = name_link_path(backup_git_dir, old_sanitized_proj_name) if old_sanitized_proj_name else None
+        # links are never removed when projects are deleted on Overleaf, so a link with this name may point elsewhere
+        if old_link_path or not name_link_points_to(link_path, proj_backup_path):
+            actions.append({'type': ACTION_LINK, 'src': proj_backup_path, 'dst': link_path,
+                            'old_dst': old_link_path})
+
+    # check if needs backup
+    backup = True
+    if proj["id"] in projects_old_id_to_info \
+            and (projects_old_id_to_info[proj["id"]]["lastUpdated"] >= proj["lastUpdated"]) \
+            and ("backup_up_to_date" in projects_old_id_to_info[proj["id"]]
+                 and projects_old_id_to_info[proj["id"]]["backup_up_to_date"]):
+        proj["backup_up_to_date"] = True
+        if pushed_to_remote_key not in projects_old_id_to_info[proj["id"]]:
+            # this is a new remote, we add it to old info for convenience as proj will inherit all old info
+            projects_old_id_to_info[proj["id"]][pushed_to_remote_key] = False
+        if old_sanitized_proj_name:
+            # we need to force a push to change the repo name on all remotes (next time each remote is updated)
+            projects_old_id_to_info[proj["id"]].update({remote_key: False
+                                                        for remote_key in projects_old_id_to_info[proj["id"]]
+                                                        if remote_key.startswith('pushed_to_remote')})
+        # Now copy info for all remotes
+        proj.update({remote_key: value
+                     for (remote_key, value) in projects_old_id_to_info[proj["id"]].items()
+                     if remote_key.startswith('pushed_to_remote')})
+        backup = False
+
+    if not csv_only:
+        if not backup:
+            logging.info("{0}/{1} Project {2} unchanged since last backup! Skip... (Overleaf url: {3})"
+                         .format(i + 1, len(projects_info_list), sanitized_proj_name, proj_git_url))
+        else:
+            actions.append({'type': predict_backup_action(proj_backup_path, path_will_hold_repo),
+                            'url': proj_git_url, 'path': proj_backup_path})
+
+        # A successful backup marks all remotes as needing an update, so a push is needed whenever we back up
+        if remote_type and proj[enable_remote_key] \
+                and (backup or not proj[pushed_to_remote_key] or force_push):
+            actions.append({'type': ACTION_PUSH, 'path': proj_backup_path, 'repo_name': sanitized_proj_name,
+                            'old_repo_name': old_sanitized_proj_name})
+    return actions
+
+
 @click.command()
 @click.option('-c', '--cookie-path', default="", type=click.Path(exists=False),
               help="Relative path to save/load the persisted Overleaf cookie.")
@@ -87,8 +264,34 @@ def sanitize_name(proj, projects_info_list, projects_old_id_to_info):
               help="Force push to remote (Default: No).")
 @click.option('--move-backups-when-possible/--never-move-backups', 'move_backup', default=True,
               help="Move local backup to user-specified location if possible (Default: Yes).")
+@click.option('-p', '--plan', 'plan_path', default="", type=click.Path(exists=False),
+              help="Path to save the execution plan (JSON) computed before backing up.")
+@click.option('--dry-run/--no-dry-run', 'dry_run', default=False,
+              help="Only show the planned work and its cost, without backing up or pushing (Default: No).")
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1),
+              help="Number of projects to back up and push in parallel (Default: 1).")
+@click.option('-e', '--export-dir', default="", type=click.Path(exists=False),
+              help="Path of folder in which to export a git bundle of each project changed since the last export.")
+@click.option('--export-full/--export-incremental', 'export_full', default=False,
+              help="Export changed projects in full rather than since their last export (Default: incremental).")
+@click.option('--maintenance/--no-maintenance', 'maintenance', default=False,
+              help="Repack local backups with too many loose objects or packs (Default: No).")
+@click.option('--maintenance-loose-threshold', default=1000, type=click.IntRange(min=0),
+              help="Number of loose objects above which a local backup is repacked (Default: 1000).")
+@click.option('--maintenance-pack-threshold', default=20, type=click.IntRange(min=0),
+              help="Number of packs above which a local backup is repacked (Default: 20).")
+@click.option('--maintenance-jobs', default=1, type=click.IntRange(min=1),
+              help="Number of local backups repacked in parallel, besides backup jobs (Default: 1).")
+@click.option('-l', '--layout', default=LAYOUT_FLAT, type=click.Choice(LAYOUTS, case_sensitive=False),
+              help="Layout of local backups: 'flat' (one folder per project name) or 'sharded' (folders per "
+                   "project id, sharded by hash, with links named after projects) (Default: flat).")
+@click.option('--max-overleaf-failures', default=3, type=click.IntRange(min=1),
+              help="Number of consecutive failed Overleaf pulls after which remaining projects are skipped "
+                   "(Default: 3).")
 def main(cookie_path, backup_dir, include_archived, remote_api_uri, remote_path, remote_type,
-         remote_name, auth_token, github_username, github_orgname, verbose, force_push, csv_only, move_backup):
+         remote_name, auth_token, github_username, github_orgname, verbose, force_push, csv_only, move_backup,
+         plan_path, dry_run, jobs, export_dir, export_full, maintenance, maintenance_loose_threshold,
+         maintenance_pack_threshold, maintenance_jobs, max_overleaf_failures, layout):
     logging.basicConfig()
     logging.getLogger().setLevel(logging.INFO)
 
@@ -155,6 +358,14 @@ def main(cookie_path, backup_dir, include_archived, remote_api_uri, remote_path,
 
         overleaf_client = OverleafClient(store["cookie"], store["csrf"])
 
+    session_status = overleaf_client.check_session()
+    if session_status == SESSION_EXPIRED:
+        logging.error("Overleaf session is not valid, please delete {} and log in again.".format(cookie_path))
+        sys.exit(EXIT_SESSION_EXPIRED)
+    if session_status == SESSION_UNREACHABLE:
+        logging.error("Could not reach Overleaf, please try again later.")
+        sys.exit(EXIT_OVERLEAF_UNAVAILABLE)
+
     projects_info_list = overleaf_client.all_projects(include_archived=include_archived)
     if not projects_info_list:
         logging.info("No projects to backup, most likely a failed login.")
@@ -197,163 +408,43 @@ def main(cookie_path, backup_dir, include_archived, remote_api_uri, remote_path,
             # One issue is that rc being default for remote_type, it will be enabled even if the user doesn't ask for it
             projects_csv_id_to_info[proj_id][enable_remote_key] = '1'
 
-    # backup projects
-    logging.info("Backing up projects..")
+    # plan the backup of all projects, then carry it out
+    logging.info("Planning backup of projects..")
+    plan = new_plan(backup_dir, remote_name, jobs)
     for i, proj in enumerate(projects_info_list):
-        proj["url_git"] = "https://git.overleaf.com/%s" % proj["id"]
-        proj_git_url = proj["url_git"]
-
-        # Use project name transformed into valid file/folder name as folder name,
-        # making sure there is no clash with existing shortened names
-        sanitized_proj_name = sanitize_name(proj, projects_info_list, projects_old_id_to_info)
-        proj_backup_path = os.path.join(backup_git_dir, sanitized_proj_name)
-        proj["sanitized_name"] = sanitized_proj_name
-        proj["backup_path"] = proj_backup_path  # this is the default, may be overwritten later
-
-        # Let's see if the user specified a backup path; if so, we stick with it
-        user_specified_backup_path = False
-        user_enable_backup = 1
-        proj["user_backup_path"] = ''
-        if proj["id"] in projects_csv_id_to_info:
-            user_enable_backup = int(projects_csv_id_to_info[proj["id"]]["enable_backup"])
-            csv_proj_backup_path = projects_csv_id_to_info[proj["id"]]["user_backup_path"]
-            old_proj_backup_path = projects_old_id_to_info[proj["id"]]["backup_path"]
-            csv_proj_backup_path = csv_proj_backup_path.strip()
-            if csv_proj_backup_path:
-                # User specified path other than default
-                user_specified_backup_path = True
-                proj_backup_path = csv_proj_backup_path
-                proj["user_backup_path"] = proj_backup_path
-                logging.info("{0}/{1} User specified path {2} for project {3} other than default..."
-                             .format(i + 1, len(projects_info_list), csv_proj_backup_path, sanitized_proj_name))
-                if not csv_only and csv_proj_backup_path != old_proj_backup_path:
-                    # user specified path is different from previous backup path
-                    if move_backup and not os.path.isdir(csv_proj_backup_path) \
-                            and os.path.isdir(old_proj_backup_path):
-                        # if user specified folder does not exist, we try moving the old backup.
-                        # we use os.renames here to create intermediate folders if needed...
-                        logging.info("{0}/{1} Moving old backup to new user specified path..."
-                                     .format(i + 1, len(projects_info_list)))
-
-                        os.renames(old_proj_backup_path, csv_proj_backup_path)
-                    else:
-                        # user specified path exists, unsafe to overwrite with old backup, force git clone or pull
-                        projects_old_id_to_info[proj["id"]]["backup_up_to_date"] = False
-                        logging.info("{0}/{1} Specified existing path different from previous path, "
-                                     "forcing backup...".format(i + 1, len(projects_info_list)))
-                        if os.path.isdir(old_proj_backup_path):
-                            logging.info("{0}/{1} Please consider deleting {2}..."
-                                         .format(i + 1, len(projects_info_list), old_proj_backup_path))
-                else:
-                    # Either we are in csv-only mode, or the user-specified path was already used before.
-                    # Either way, the current backup path should stay the same as in the json file.
-                    proj["backup_path"] = old_proj_backup_path
-            elif "user_backup_path" in projects_old_id_to_info[proj["id"]] \
-                    and projects_old_id_to_info[proj["id"]]["user_backup_path"] != csv_proj_backup_path:
-                # User stopped specifying a backup path
-                projects_old_id_to_info[proj["id"]]["backup_up_to_date"] = False
-                logging.info("{0}/{1} User no longer specifying non-default path, going back to default, "
-                             "forcing backup...".format(i + 1, len(projects_info_list)))
-                if os.path.isdir(old_proj_backup_path):
-                    logging.info("{0}/{1} Please consider deleting {2}..."
-                                 .format(i + 1, len(projects_info_list), old_proj_backup_path))
-
-        proj["enable_backup"] = user_enable_backup
-        proj["backup_up_to_date"] = False
-        # read info about whether remotes are enabled or not, defaulting to no backup
-        for remote_key in set_of_enable_remote_keys:
-            if proj["id"] in projects_csv_id_to_info and remote_key in projects_csv_id_to_info[proj["id"]]:
-                proj[remote_key] = int(projects_csv_id_to_info[proj["id"]][remote_key])
-            else:  # this only applies to projects that were added while another remote was considered
-                proj[remote_key] = 0
-        proj[pushed_to_remote_key] = False
-
-        if not user_enable_backup:
-            if proj[enable_remote_key]:
-                logging.info("{0}/{1} User asked to skip local backup but to push to remote for project {2}."
-                             "These settings are incompatible, as local backup is needed for remote push."
-                             .format(i + 1, len(projects_info_list), sanitized_proj_name))
-            # User does not want local backup for this project, skip everything else
-            continue
-
-        # Handle a potential project name change in Overleaf
-        if proj["id"] in projects_old_id_to_info \
-                and (projects_old_id_to_info[proj["id"]]["sanitized_name"] != sanitized_proj_name):
-            # specifying old_sanitized_proj_name will force an update in the remote
-            old_sanitized_proj_name = projects_old_id_to_info[proj["id"]]["sanitized_name"]
-            old_proj_backup_path = projects_old_id_to_info[proj["id"]]["backup_path"]
-            # only change local folder name if not specified by user
-            if not user_specified_backup_path:
-                if os.path.isdir(old_proj_backup_path):
-                    logging.info("{0}/{1} Project {2} has changed name from {4} since last backup, "
-                                 "renaming local folder... (Overleaf url: {3})"
-                                 .format(i + 1, len(projects_info_list), sanitized_proj_name, proj_git_url,
-                                         old_sanitized_proj_name))
-                    os.rename(old_proj_backup_path, proj_backup_path)
-                else:
-                    # There should really be a folder, so if there is none, let's assume we need to backup
-                    projects_old_id_to_info[proj["id"]]["backup_up_to_date"] = False
-                    logging.info("{0}/{1} Couldn't find previous local backup folder {2} for project {3}, "
-                                 "redownloading to folder {4}..."
-                                 .format(i + 1, len(projects_info_list), old_proj_backup_path, sanitized_proj_name,
-                                         proj_backup_path))
-        else:
-            old_sanitized_proj_name = None
-
-        # check if needs backup
-        backup = True
-        if proj["id"] in projects_old_id_to_info \
-                and (projects_old_id_to_info[proj["id"]]["lastUpdated"] >= proj["lastUpdated"]) \
-                and ("backup_up_to_date" in projects_old_id_to_info[proj["id"]]
-                     and projects_old_id_to_info[proj["id"]]["backup_up_to_date"]):
-            proj["backup_up_to_date"] = True
-            if pushed_to_remote_key not in projects_old_id_to_info[proj["id"]]:  
-                # this is a new remote, we add it to old info for convenience as proj will inherit all old info
-                projects_old_id_to_info[proj["id"]][pushed_to_remote_key] = False
-            if old_sanitized_proj_name:  
-                # we need to force a push to change the repo name on all remotes (next time each remote is updated)
-                projects_old_id_to_info[proj["id"]].update({remote_key: False
-                                                            for remote_key in projects_old_id_to_info[proj["id"]]
-                                                            if remote_key.startswith('pushed_to_remote')})
-            # Now copy info for all remotes
-            proj.update({remote_key: value
-                         for (remote_key, value) in projects_old_id_to_info[proj["id"]].items()
-                         if remote_key.startswith('pushed_to_remote')})
-            backup = False
-
-        if not csv_only:
-            if not backup:
-                logging.info("{0}/{1} Project {2} unchanged since last backup! Skip... (Overleaf url: {3})"
-                             .format(i + 1, len(projects_info_list), sanitized_proj_name, proj_git_url))
-            else:
-                logging.info("{0}/{1} Backing up project {2} to {4}  (Overleaf url: {3})"
-                             .format(i+1, len(projects_info_list), sanitized_proj_name, proj_git_url, proj_backup_path))
-
-                try:
-                    create_or_update_local_backup(proj_git_url, proj_backup_path)
-                    logging.info("Backup successful!")
-                    proj["backup_up_to_date"] = True
-                    # All remotes will need to be updated
-                    proj.update({remote_key: False for remote_key in proj
-                                 if remote_key.startswith('pushed_to_remote')})
-                    # in case backup path was not default, we update it here now that backup did succeed
-                    proj["backup_path"] = proj_backup_path
-                except RuntimeError:
-                    logging.exception("Something went wrong during Overleaf pull, moving on!")
-
-            if remote_type and proj[enable_remote_key] \
-                    and proj["backup_up_to_date"] and (not proj[pushed_to_remote_key] or force_push):
-                try:
-                    push_to_remote(remote_api_uri, remote_path, remote_name, remote_type, auth_token,
-                                   sanitized_proj_name, proj_backup_path,
-                                   old_repo_name=old_sanitized_proj_name,
-                                   github_username=github_username,
-                                   github_orgname=github_orgname,
-                                   verbose=verbose)
-                    logging.info("Push successful!")
-                    proj[pushed_to_remote_key] = True
-                except (RuntimeError, OSError):
-                    logging.exception("Something went wrong during push to other remote, moving on!")
+        add_project_to_plan(plan, i, proj, plan_project_actions(
+            i, proj, projects_info_list, projects_old_id_to_info, projects_csv_id_to_info,
+            set_of_enable_remote_keys, enable_remote_key, pushed_to_remote_key, backup_git_dir,
+            remote_type, csv_only, force_push, move_backup, layout))
+
+    if plan_path:
+        save_plan(plan, plan_path)
+    if dry_run:
+        log_plan(plan)
+        logging.info("Dry run, nothing was backed up or written to {}.".format(backup_dir))
+        return True
+
+    maintenance_scheduler = None
+    if maintenance and not csv_only:
+        maintenance_scheduler = MaintenanceScheduler(maintenance_loose_threshold, maintenance_pack_threshold,
+                                                     jobs=maintenance_jobs)
+
+    overleaf_circuit_breaker = CircuitBreaker(max_overleaf_failures, name="Overleaf")
+
+    logging.info("Backing up projects..")
+    execute_plan(plan, projects_info_list, pushed_to_remote_key, {
+        'remote_api_uri': remote_api_uri,
+        'remote_path': remote_path,
+        'remote_name': remote_name,
+        'remote_type': remote_type,
+        'auth_token': auth_token,
+        'github_username': github_username,
+        'github_orgname': github_orgname,
+        'verbose': verbose,
+    }, after_project=maintenance_scheduler.submit if maintenance_scheduler else None,
+        circuit_breaker=overleaf_circuit_breaker)
+    if maintenance_scheduler:
+        logging.info("Ran maintenance on {} local backups.".format(maintenance_scheduler.wait()))
 
     if not csv_only:
         logging.info("Successfully backed up {} projects out of {}.".format(
@@ -363,6 +454,9 @@ def main(cookie_path, backup_dir, include_archived, remote_api_uri, remote_path,
             logging.info("Successfully pushed {} projects out of {} to remote {}.".format(
                 len([proj for proj in projects_info_list if proj[pushed_to_remote_key]]),
                 len(projects_info_list), remote_name))
+        if export_dir:
+            logging.info("Exporting projects..")
+            export_projects(projects_info_list, export_dir, full=export_full, jobs=jobs)
     json.dump(projects_info_list, open(projects_json_file, "w"))
     logging.info("Info for {0} projects saved to {1}!".format(len(projects_info_list), projects_json_file))
 
@@ -374,6 +468,24 @@ def main(cookie_path, backup_dir, include_archived, remote_api_uri, remote_path,
             proj['sanitized_name'] = proj['sanitized_name'].ljust(MAX_FILENAME_LENGTH)
             writer.writerow({k: proj.get(k, "") for k in fieldnames})
 
+    if overleaf_circuit_breaker.is_open():
+        # Progress was saved above, skipped projects are still out of date and will be backed up next time
+        if FAILURE_GIT_AUTH in overleaf_circuit_breaker.failure_reasons():
+            # git authenticates to Overleaf with its own credentials, not the session cookie
+            logging.error("Overleaf rejected git credentials, please update the credentials (e.g., git token) "
+                          "used for git.overleaf.com. Some projects were not backed up.")
+            sys.exit(EXIT_GIT_AUTH_FAILED)
+        session_status = overleaf_client.check_session()
+        if session_status == SESSION_EXPIRED:
+            logging.error("Overleaf session expired during backup, please delete {} and log in again."
+                          .format(cookie_path))
+            sys.exit(EXIT_SESSION_EXPIRED)
+        if session_status == SESSION_UNREACHABLE:
+            logging.error("Overleaf became unreachable, some projects were not backed up.")
+        else:
+            logging.error("Overleaf git bridge unavailable, some projects were not backed up.")
+        sys.exit(EXIT_OVERLEAF_UNAVAILABLE)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,62 @@
+import os
+import hashlib
+import logging
+
+# Flat layout: one folder per project, named after the project, directly in git_backup/
+LAYOUT_FLAT = "flat"
+# Sharded layout: one folder per project id in git_backup/by-id/<shard>/<id>, where the shard is a prefix of
+# a hash of the id, with git_backup/by-name/<sanitized name> symlinks to keep a human-readable view
+LAYOUT_SHARDED = "sharded"
+LAYOUTS = (LAYOUT_FLAT, LAYOUT_SHARDED)
+
+BY_ID_DIR = "by-id"
+BY_NAME_DIR = "by-name"
+# Project folders and links must not use these names, which the sharded layout uses in git_backup/
+RESERVED_NAMES = (BY_ID_DIR, BY_NAME_DIR)
+# 2 hex characters give 256 shards, enough to keep each folder small for tens of thousands of projects
+SHARD_PREFIX_LENGTH = 2
+
+
+def is_reserved_name(sanitized_name):
+    # compared case-insensitively, for case-insensitive file systems (e.g., macOS, Windows)
+    return sanitized_name.lower() in RESERVED_NAMES
+
+
+def shard_of(proj_id):
+    # Overleaf ids start with a timestamp, so they are hashed to spread projects evenly over the shards
+    return hashlib.sha1(proj_id.encode('utf-8')).hexdigest()[:SHARD_PREFIX_LENGTH]
+
+
+def default_backup_path(backup_git_dir, proj_id, sanitized_name, layout=LAYOUT_FLAT):
+    if layout == LAYOUT_SHARDED:
+        return os.path.join(backup_git_dir, BY_ID_DIR, shard_of(proj_id), proj_id)
+    return os.path.join(backup_git_dir, sanitized_name)
+
+
+def name_link_path(backup_git_dir, sanitized_name):
+    return os.path.join(backup_git_dir, BY_NAME_DIR, sanitized_name)
+
+
+def name_link_points_to(link, target):
+    return os.path.islink(link) and os.readlink(link) == os.path.relpath(target, os.path.dirname(link))
+
+
+def update_name_link(target, link, old_link=None):
+    """
+    Point the human-readable link to the backup folder, removing the link for the previous project name if any
+    """
+    # the previous name may already have been given to another project, whose link must be kept
+    if old_link and name_link_points_to(old_link, target):
+        os.remove(old_link)
+    if name_link_points_to(link, target):
+        return
+    if os.path.islink(link):
+        # e.g., left behind by a project deleted on Overleaf, whose name is now used by this project
+        os.remove(link)
+    if not os.path.isdir(os.path.dirname(link)):
+        os.makedirs(os.path.dirname(link))
+    try:
+        os.symlink(os.path.relpath(target, os.path.dirname(link)), link, target_is_directory=True)
+    except OSError:
+        # e.g., Windows without symlink privilege: projects.csv and projects.json still map names to folders
+        logging.exception("Could not create link {0} to {1}, moving on!".format(link, target))
@@ -0,0 +1,234 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from storage.BackupLayout import update_name_link
+from storage.GitMaintenance import GIT_STATS_KEY
+from storage.GitStorage import create_or_update_local_backup, push_to_remote, OverleafAccessError
+
+PLAN_VERSION = 1
+
+# Local actions only touch the file system and are run serially, in plan order, before anything else,
+# since a move or rename may free (or take) a folder name used by another project.
+ACTION_MOVE = "move"
+ACTION_RENAME = "rename"
+ACTION_LINK = "link"
+LOCAL_ACTIONS = (ACTION_MOVE, ACTION_RENAME, ACTION_LINK)
+# Network actions are chained per project (backup, then push) and projects are run in parallel.
+ACTION_CLONE = "clone"
+ACTION_PULL = "pull"
+ACTION_PUSH = "push"
+BACKUP_ACTIONS = (ACTION_CLONE, ACTION_PULL)
+# Reason given to the circuit breaker when git credentials for Overleaf are rejected
+FAILURE_GIT_AUTH = "git_auth"
+
+# Rough number of network round trips needed by each action, used to estimate the cost of a plan.
+# A push needs a lookup (and possibly a rename or creation) on the remote API before the git push itself.
+ACTION_COST = {
+    ACTION_MOVE: 0,
+    ACTION_RENAME: 0,
+    ACTION_LINK: 0,
+    ACTION_CLONE: 1,
+    ACTION_PULL: 1,
+    ACTION_PUSH: 3,
+}
+
+
+def new_plan(backup_dir, remote_name, jobs):
+    return {
+        'version': PLAN_VERSION,
+        'backup_dir': backup_dir,
+        'remote_name': remote_name,
+        'jobs': jobs,
+        'projects': [],
+    }
+
+
+def add_project_to_plan(plan, index, proj, actions):
+    plan['projects'].append({
+        'index': index,
+        'id': proj["id"],
+        'sanitized_name': proj["sanitized_name"],
+        'actions': actions,
+    })
+
+
+def predict_backup_action(repo_dir, path_will_hold_repo=False):
+    """
+    Predict whether create_or_update_local_backup will clone or pull, without touching the disk
+    :param repo_dir: local backup folder
+    :param path_will_hold_repo: True if an earlier action of the plan moves an existing backup to repo_dir
+    :return: ACTION_PULL or ACTION_CLONE
+    """
+    if path_will_hold_repo or os.path.isdir(os.path.join(repo_dir, ".git")):
+        return ACTION_PULL
+    return ACTION_CLONE
+
+
+def summarize_plan(plan):
+    counts = {action_type: 0 for action_type in ACTION_COST}
+    for entry in plan['projects']:
+        for action in entry['actions']:
+            counts[action['type']] += 1
+    return {
+        'projects': len(plan['projects']),
+        'projects_with_work': len([entry for entry in plan['projects'] if entry['actions']]),
+        'actions': counts,
+        'network_operations': sum(ACTION_COST[action_type] * count for action_type, count in counts.items()),
+    }
+
+
+def describe_action(action):
+    if action['type'] in LOCAL_ACTIONS:
+        return "{0} {1} -> {2}".format(action['type'], action['src'], action['dst'])
+    if action['type'] in BACKUP_ACTIONS:
+        return "{0} {1} into {2}".format(action['type'], action['url'], action['path'])
+    return "push {0} to remote {1}".format(action['path'], action['repo_name'])
+
+
+def log_plan(plan):
+    n_projects = len(plan['projects'])
+    for entry in plan['projects']:
+        for action in entry['actions']:
+            logging.info("{0}/{1} [plan] {2}".format(entry['index'] + 1, n_projects, describe_action(action)))
+    summary = plan.get('summary') or summarize_plan(plan)
+    logging.info("Plan: {0} of {1} projects need work; {2}; about {3} network operations."
+                 .format(summary['projects_with_work'], summary['projects'],
+                         ", ".join("{0} {1}".format(count, action_type)
+                                   for action_type, count in summary['actions'].items()),
+                         summary['network_operations']))
+
+
+def save_plan(plan, plan_path):
+    plan['summary'] = summarize_plan(plan)
+    with open(plan_path, "w") as f:
+        json.dump(plan, f, indent=2)
+    logging.info("Execution plan saved to {}".format(plan_path))
+
+
+def _run_local_actions(plan):
+    n_projects = len(plan['projects'])
+    local_actions = [(entry, action) for entry in plan['projects'] for action in entry['actions']
+                     if action['type'] in LOCAL_ACTIONS]
+    # Folders using a reserved name are renamed first, before other projects are moved into the sharded layout
+    # (sorting is stable, so plan order is kept otherwise)
+    local_actions.sort(key=lambda entry_action: not entry_action[1].get('frees_reserved_name'))
+    for entry, action in local_actions:
+        if action['type'] == ACTION_MOVE:
+            logging.info("{0}/{1} Moving old backup to new user specified path..."
+                         .format(entry['index'] + 1, n_projects))
+            # we use os.renames here to create intermediate folders if needed...
+            os.renames(action['src'], action['dst'])
+        elif action['type'] == ACTION_RENAME:
+            if action.get('old_name'):
+                logging.info("{0}/{1} Project {2} has changed name from {3} since last backup, "
+                             "renaming local folder {4} to {5}..."
+                             .format(entry['index'] + 1, n_projects, entry['sanitized_name'],
+                                     action['old_name'], action['src'], action['dst']))
+            else:
+                logging.info("{0}/{1} Moving local folder {2} of project {3} to {4}..."
+                             .format(entry['index'] + 1, n_projects, action['src'], entry['sanitized_name'],
+                                     action['dst']))
+            src = os.path.normpath(action['src'])
+            dst = os.path.normpath(action['dst'])
+            if dst.startswith(src + os.sep):
+                # e.g., a flat folder named like the by-id folder, moved into the sharded layout:
+                # a folder cannot be renamed into itself, so first move it out of the way
+                os.rename(src, src + ".moving")
+                src = src + ".moving"
+            # the parent folder may not exist yet when switching to the sharded layout
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            os.rename(src, dst)
+        elif action['type'] == ACTION_LINK:
+            update_name_link(action['src'], action['dst'], old_link=action['old_dst'])
+
+
+def _run_network_actions(entry, proj, n_projects, pushed_to_remote_key, push_options, after_project=None,
+                         circuit_breaker=None):
+    updated = False
+    for action in entry['actions']:
+        if action['type'] in BACKUP_ACTIONS:
+            if circuit_breaker is not None and circuit_breaker.is_open():
+                # The project stays out of date, so it will be backed up next time (and not pushed now)
+                logging.info("{0}/{1} Skipping backup of project {2}, Overleaf is unavailable"
+                             .format(entry['index'] + 1, n_projects, entry['sanitized_name']))
+                continue
+            logging.info("{0}/{1} Backing up project {2} to {4}  (Overleaf url: {3})"
+                         .format(entry['index'] + 1, n_projects, entry['sanitized_name'], action['url'],
+                                 action['path']))
+            try:
+                create_or_update_local_backup(action['url'], action['path'], circuit_breaker=circuit_breaker)
+                if circuit_breaker is not None:
+                    circuit_breaker.record_success()
+                logging.info("{0}/{1} Backup of project {2} successful!"
+                             .format(entry['index'] + 1, n_projects, entry['sanitized_name']))
+                proj["backup_up_to_date"] = True
+                # All remotes will need to be updated
+                proj.update({remote_key: False for remote_key in proj
+                             if remote_key.startswith('pushed_to_remote')})
+                # in case backup path was not default, we update it here now that backup did succeed
+                proj["backup_path"] = action['path']
+                # Repository statistics no longer match the repo, drop them so that the next maintenance
+                # (in this run or a later one) counts objects again
+                proj.pop(GIT_STATS_KEY, None)
+                updated = True
+            except OverleafAccessError as ex:
+                logging.exception("{0}/{1} Could not pull project {2} from Overleaf, moving on!"
+                                  .format(entry['index'] + 1, n_projects, entry['sanitized_name']))
+                if circuit_breaker is not None:
+                    circuit_breaker.record_failure(reason=FAILURE_GIT_AUTH if ex.auth_failure else None)
+            except RuntimeError:
+                logging.exception("{0}/{1} Something went wrong during Overleaf pull of project {2}, moving on!"
+                                  .format(entry['index'] + 1, n_projects, entry['sanitized_name']))
+        elif action['type'] == ACTION_PUSH:
+            # A failed backup leaves the project out of date, in which case there is nothing safe to push
+            if not proj["backup_up_to_date"]:
+                continue
+            try:
+                push_to_remote(push_options['remote_api_uri'], push_options['remote_path'],
+                               push_options['remote_name'], push_options['remote_type'],
+                               push_options['auth_token'], action['repo_name'], action['path'],
+                               old_repo_name=action['old_repo_name'],
+                               github_username=push_options['github_username'],
+                               github_orgname=push_options['github_orgname'],
+                               verbose=push_options['verbose'])
+                logging.info("{0}/{1} Push of project {2} successful!"
+                             .format(entry['index'] + 1, n_projects, entry['sanitized_name']))
+                proj[pushed_to_remote_key] = True
+            except (RuntimeError, OSError):
+                logging.exception("{0}/{1} Something went wrong during push of project {2} to other remote, "
+                                  "moving on!".format(entry['index'] + 1, n_projects, entry['sanitized_name']))
+    if after_project is not None:
+        after_project(proj, updated)
+
+
+def execute_plan(plan, projects_info_list, pushed_to_remote_key, push_options, after_project=None,
+                 circuit_breaker=None):
+    """
+    Run a plan built for projects_info_list, updating the project info in place
+    :param plan: plan as returned by new_plan and filled by add_project_to_plan
+    :param projects_info_list: list of project info, matched to plan entries by id
+    :param pushed_to_remote_key: project info key recording whether the project was pushed to the current remote
+    :param push_options: keyword arguments describing the remote, as taken by push_to_remote
+    :param after_project: optional callable(proj, updated), called once all actions of a project are done,
+        with updated True if its backup was cloned or pulled
+    :param circuit_breaker: optional CircuitBreaker shared by all workers; once open, remaining backups are skipped
+    """
+    _run_local_actions(plan)
+
+    projects_by_id = {proj["id"]: proj for proj in projects_info_list}
+    n_projects = len(plan['projects'])
+    entries = []
+    for entry in plan['projects']:
+        if any(action['type'] not in LOCAL_ACTIONS for action in entry['actions']):
+            entries.append(entry)
+        elif after_project is not None:
+            after_project(projects_by_id[entry['id']], False)
+    with ThreadPoolExecutor(max_workers=max(1, plan['jobs'])) as executor:
+        futures = [executor.submit(_run_network_actions, entry, projects_by_id[entry['id']], n_projects,
+                                   pushed_to_remote_key, push_options, after_project, circuit_breaker)
+                   for entry in entries]
+        for future in futures:
+            future.result()
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import git
+from git import Repo
+
+EXPORT_MANIFEST = "export_manifest.json"
+
+
+class HashingWriter(object):
+    """
+    File wrapper computing the checksum and size of what is written through it,
+    so that a bundle can be streamed to disk and checksummed in a single pass
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+
+def load_export_manifest(export_dir):
+    manifest_file = os.path.join(export_dir, EXPORT_MANIFEST)
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, mode="r") as f:
+            return json.load(f)
+    return {'projects': {}}
+
+
+def save_export_manifest(export_dir, manifest):
+    manifest_file = os.path.join(export_dir, EXPORT_MANIFEST)
+    with open(manifest_file, mode="w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def export_bundle(repo_dir, bundle_path, base_commit=None):
+    """
+    Stream a git bundle of repo_dir straight to bundle_path, without temporary files
+    :param repo_dir: local backup folder
+    :param bundle_path: bundle file to create
+    :param base_commit: if given, only commits since base_commit are bundled (base_commit becomes a prerequisite)
+    :return: dict with the exported commit, its base, and the checksum and size of the bundle
+    """
+    myrepo = Repo(repo_dir)
+    commit = myrepo.head.commit.hexsha
+    # Bundle the current branch along with HEAD, so that cloning the bundle checks out that branch
+    # rather than a detached HEAD, and later bundles can be pulled into it
+    rev_args = ["HEAD"]
+    if not myrepo.head.is_detached:
+        rev_args.insert(0, myrepo.active_branch.name)
+    if base_commit:
+        rev_args.append("^{}".format(base_commit))
+    try:
+        with open(bundle_path, "wb") as f:
+            writer = HashingWriter(f)
+            myrepo.git.bundle("create", "-", *rev_args, output_stream=writer)
+    except git.GitCommandError:
+        # Do not leave a truncated bundle behind
+        if os.path.isfile(bundle_path):
+            os.remove(bundle_path)
+        raise
+    return {
+        'commit': commit,
+        'base_commit': base_commit,
+        'sha256': writer.sha256.hexdigest(),
+        'size': writer.size,
+    }
+
+
+def _export_project(proj, export_dir, last_export, full):
+    myrepo = Repo(proj["backup_path"])
+    commit = myrepo.head.commit.hexsha
+    if last_export and last_export['commit'] == commit:
+        return None
+    base_commit = None
+    if last_export and not full:
+        try:
+            if myrepo.is_ancestor(last_export['commit'], commit):
+                base_commit = last_export['commit']
+        except git.GitCommandError:
+            # previous commit is unknown to this repo (e.g., history was rewritten), export everything
+            pass
+    project_export_dir = os.path.join(export_dir, proj["id"])
+    if not os.path.isdir(project_export_dir):
+        os.makedirs(project_export_dir)
+    bundle_name = "{0}_{1}.bundle".format(time.strftime("%Y%m%d%H%M%S"), commit[:12])
+    bundle_info = export_bundle(proj["backup_path"], os.path.join(project_export_dir, bundle_name),
+                                base_commit=base_commit)
+    bundle_info['bundle'] = os.path.join(proj["id"], bundle_name)
+    bundle_info['sanitized_name'] = proj["sanitized_name"]
+    bundle_info['created'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return bundle_info
+
+
+def export_projects(projects_info_list, export_dir, full=False, jobs=1):
+    """
+    Export a bundle for each backed up project that changed since the previous export, and record it in the manifest
+    :param projects_info_list: list of project info, as saved in projects.json
+    :param export_dir: folder in which to store the bundles and the manifest
+    :param full: if True, changed projects are exported in full instead of relative to their previous export
+    :param jobs: number of projects exported in parallel
+    :return: number of projects exported
+    """
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+    manifest = load_export_manifest(export_dir)
+    projects = [proj for proj in projects_info_list
+                if proj.get("enable_backup") and proj.get("backup_up_to_date") and os.path.isdir(proj["backup_path"])]
+
+    def export_one(proj):
+        history = manifest['projects'].get(proj["id"], [])
+        try:
+            return proj, _export_project(proj, export_dir, history[-1] if history else None, full)
+        except (git.GitCommandError, git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError,
+                ValueError, OSError):
+            logging.exception("Something went wrong during export of project {}, moving on!"
+                              .format(proj["sanitized_name"]))
+            return proj, None
+
+    n_exported = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for proj, bundle_info in executor.map(export_one, projects):
+            if bundle_info is None:
+                continue
+            manifest['projects'].setdefault(proj["id"], []).append(bundle_info)
+            n_exported += 1
+            logging.info("Exported project {0} to {1}".format(proj["sanitized_name"], bundle_info['bundle']))
+
+    save_export_manifest(export_dir, manifest)
+    logging.info("Exported {0} changed projects out of {1} to {2}.".format(n_exported, len(projects), export_dir))
+    return n_exported
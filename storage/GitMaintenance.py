@@ -0,0 +1,95 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import git
+from git import Repo
+
+# Project info key under which repository statistics are kept in projects.json
+GIT_STATS_KEY = "git_stats"
+
+
+def count_objects(repo_dir):
+    """
+    Count loose objects and packs of a git repo, as reported by git count-objects
+    :return: dict with the number of loose objects, their size in KiB, and the number of packs
+    """
+    output = Repo(repo_dir).git.count_objects('-v')
+    stats = {}
+    for line in output.splitlines():
+        key, _, value = line.partition(':')
+        stats[key.strip()] = value.strip()
+    return {
+        'loose_objects': int(stats.get('count', 0)),
+        'loose_size_kb': int(stats.get('size', 0)),
+        'packs': int(stats.get('packs', 0)),
+    }
+
+
+def run_maintenance(repo_dir):
+    """
+    Repack a git repo into a single pack, prune old unreachable loose objects and write the commit-graph
+    """
+    myrepo = Repo(repo_dir)
+    myrepo.git.gc('--quiet')
+    # gc only writes the commit-graph if gc.writeCommitGraph is enabled (the default, but it can be turned off
+    # in the user's git config, and older git versions lack it), so write it explicitly
+    myrepo.git.commit_graph('write', '--reachable')
+
+
+class MaintenanceScheduler(object):
+    """
+    Keeps the repository statistics of each project up to date in the project info,
+    and repacks repos over a threshold on its own bounded pool, separate from the backup workers.
+    """
+
+    def __init__(self, loose_threshold, pack_threshold, jobs=1):
+        self._loose_threshold = loose_threshold
+        self._pack_threshold = pack_threshold
+        self._executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self._futures = []
+
+    def needs_maintenance(self, stats):
+        return stats['loose_objects'] > self._loose_threshold or stats['packs'] > self._pack_threshold
+
+    def submit(self, proj, updated):
+        """
+        Schedule statistics update and maintenance of a project once nothing else uses its backup
+        :param proj: project info, updated in place
+        :param updated: True if the backup was just cloned or pulled, so that carried over statistics are stale
+        """
+        if not proj.get("enable_backup") or not os.path.isdir(proj["backup_path"]):
+            return
+        if not updated and GIT_STATS_KEY in proj \
+                and not self.needs_maintenance(proj[GIT_STATS_KEY]):
+            # Nothing was fetched since statistics were last taken, so there is no need to look at the repo again
+            return
+        self._futures.append(self._executor.submit(self._maintain, proj))
+
+    def _maintain(self, proj):
+        repo_dir = proj["backup_path"]
+        maintained = False
+        try:
+            stats = count_objects(repo_dir)
+            stats['last_maintenance'] = proj.get(GIT_STATS_KEY, {}).get('last_maintenance')
+            if self.needs_maintenance(stats):
+                logging.info("Running maintenance on {0} ({1} loose objects, {2} packs)..."
+                             .format(repo_dir, stats['loose_objects'], stats['packs']))
+                run_maintenance(repo_dir)
+                stats.update(count_objects(repo_dir))
+                stats['last_maintenance'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+                maintained = True
+            proj[GIT_STATS_KEY] = stats
+        except (git.GitCommandError, git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+            logging.exception("Something went wrong during maintenance of {}, moving on!".format(repo_dir))
+        return maintained
+
+    def wait(self):
+        """
+        Wait for all scheduled maintenance to finish
+        :return: number of repos on which maintenance was run
+        """
+        n_maintained = len([future for future in self._futures if future.result()])
+        self._executor.shutdown()
+        return n_maintained
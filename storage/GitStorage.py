@@ -8,6 +8,31 @@ from git import Repo
 from urllib.parse import urljoin
 
 RETRY = 3
+# Messages from git meaning that retrying will not help until the user logs in again
+AUTH_ERROR_MESSAGES = (
+    "Authentication failed",
+    "could not read Username",
+    "terminal prompts disabled",
+    "returned error: 401",
+    "returned error: 403",
+)
+
+
+class OverleafAccessError(RuntimeError):
+    """
+    Overleaf could not be reached through git, either because of authentication or of the git bridge itself
+    (as opposed to a problem with the local folder)
+    """
+
+    def __init__(self, message="", auth_failure=False):
+        super(OverleafAccessError, self).__init__(message)
+        # True if git credentials for Overleaf were rejected, so that retrying later will not help
+        self.auth_failure = auth_failure
+
+
+def is_auth_error(ex):
+    message = str(ex.stderr) if ex.stderr else str(ex)
+    return any(auth_message in message for auth_message in AUTH_ERROR_MESSAGES)
 
 
 def is_git_repo(path):
@@ -110,7 +135,7 @@ def get_github_repo(remote_api_uri, remote_path, repo_name, github_username, aut
     return r.json()
 
 
-def create_or_update_local_backup(git_url, repo_dir):
+def create_or_update_local_backup(git_url, repo_dir, circuit_breaker=None):
     if not os.path.isdir(repo_dir):
         # Create folder with parents
         os.makedirs(repo_dir)
@@ -132,6 +157,12 @@ def create_or_update_local_backup(git_url, repo_dir):
                     # existing but empty folder: clone
                     Repo.clone_from(git_url, repo_dir)
             except git.GitCommandError as ex:
+                if is_auth_error(ex):
+                    logging.error("Authentication to Overleaf git failed, not retrying: {}".format(ex))
+                    raise OverleafAccessError(auth_failure=True)
+                if circuit_breaker is not None and circuit_breaker.is_open():
+                    # Other projects already failed too many times in a row, no point in retrying this one
+                    raise OverleafAccessError
                 logging.info("error:{0}: retry:{1}/{2}".format(ex, i, RETRY))
                 time.sleep(2)
                 logging.info("retrying")
@@ -142,7 +173,8 @@ def create_or_update_local_backup(git_url, repo_dir):
                 return True
         else:
             logging.exception("Max retry count reached without success")
-        # We should only reach this if max retry count was reached without success or the git repo did not match
+            raise OverleafAccessError
+        # We should only reach this if the git repo did not match
         raise RuntimeError
     else:
         # Existing non empty folder that is not already a git repo: we can't do anything
@@ -0,0 +1,52 @@
+import logging
+import threading
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failures shared by all workers, and opens once too many happened in a row,
+    so that queued work can be dropped instead of failing one item at a time
+    """
+
+    def __init__(self, max_consecutive_failures, name="circuit"):
+        self._max_consecutive_failures = max_consecutive_failures
+        self._name = name
+        self._consecutive_failures = 0
+        # reasons of the consecutive failures, kept once the circuit is open to tell why it opened
+        self._failure_reasons = []
+        self._open = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            return self._open
+
+    def failure_reasons(self):
+        """
+        :return: reasons given for the consecutive failures, i.e., those that opened the circuit if it is open
+        """
+        with self._lock:
+            return list(self._failure_reasons)
+
+    def record_success(self):
+        with self._lock:
+            if not self._open:
+                self._consecutive_failures = 0
+                self._failure_reasons = []
+
+    def record_failure(self, reason=None):
+        """
+        :param reason: optional reason of the failure, reported by failure_reasons
+        :return: True if this failure opened the circuit
+        """
+        with self._lock:
+            if self._open:
+                return False
+            self._consecutive_failures += 1
+            self._failure_reasons.append(reason)
+            if self._consecutive_failures >= self._max_consecutive_failures:
+                self._open = True
+                logging.error("{0} consecutive failures, stopping all remaining {1} work."
+                              .format(self._consecutive_failures, self._name))
+                return True
+            return False